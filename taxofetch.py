@@ -1,8 +1,22 @@
+import numpy as np
 import pandas as pd
 import os
+import re
 import sys
 import urllib.request
+import urllib.error
+import email.utils
 import argparse
+import gc
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError: # Optional: faster summary parsing
+    pa = pacsv = None
 
 GROUP_MAPPING = {
     'plant':            'plant',
@@ -21,6 +35,30 @@ GROUP_MAPPING = {
     'viral':            'viral',
     'protozoa':         'protozoa'
 }
+
+# Seconds to wait on NCBI before falling back to a cached summary (offline/firewalled nodes)
+SUMMARY_TIMEOUT = 60
+
+# Parquet snapshot format; bump whenever stored columns, scoring or name normalization change
+SNAPSHOT_VERSION = 2
+
+# Only these columns of assembly_summary.txt are used
+SUMMARY_COLUMNS = ['assembly_accession', 'refseq_category', 'organism_name', 'assembly_level', 'ftp_path']
+# Arrow-backed strings are far smaller than Python str objects for bacteria-scale catalogs
+STRING_DTYPE = 'string[pyarrow]' if pa is not None else str
+SUMMARY_DTYPES = {'assembly_accession': STRING_DTYPE, 'refseq_category': 'category', 'organism_name': STRING_DTYPE,
+                  'assembly_level': 'category', 'ftp_path': STRING_DTYPE}
+
+# Runs of whitespace in organism names, compiled once
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Ranking Weights (worst to best: score = position + 1, unknown values score 0)
+CATEGORY_ORDER = ['na', 'representative genome', 'reference genome']
+LEVEL_ORDER = ['Contig', 'Scaffold', 'Chromosome', 'Complete Genome']
+SOURCE_ORDER = ['GENBANK', 'REFSEQ'] # Prefer RefSeq if quality is identical
+# Shared categories so the tag survives pd.concat as a categorical
+SOURCE_DTYPE = pd.CategoricalDtype(SOURCE_ORDER)
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Download Genomes from NCBI (RefSeq & GenBank).")
     
@@ -35,157 +73,332 @@ def parse_args():
     parser.add_argument('-s', '--source', default='both', choices=['refseq', 'genbank', 'both'],
                         help="Database to search. 'both' searches both and prioritizes RefSeq. (Default: both)")
     
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help="Number of parallel downloads in the generated script. (Default: 4)")
+
     parser.add_argument('--clean', action='store_true', help="Force re-download of NCBI assembly summary files.")
 
     return parser.parse_args()
 
-def download_and_load_summary(ncbi_group, db_source, force_download=False):
+def fetch_summary(url, local_filename, meta_filename):
+    """
+    Conditional GET using the Last-Modified/ETag saved from the previous download.
+    Returns True if a new file was downloaded, False if the cached copy is current.
+    """
+    meta = {}
+    if os.path.exists(local_filename):
+        if os.path.exists(meta_filename):
+            with open(meta_filename) as f:
+                meta = json.load(f)
+        else: # Cached before .meta files existed: the file's own mtime is the best validator we have
+            meta = {'last_modified': email.utils.formatdate(os.path.getmtime(local_filename), usegmt=True)}
+
+    req = urllib.request.Request(url)
+    if meta.get('last_modified'):
+        req.add_header('If-Modified-Since', meta['last_modified'])
+    if meta.get('etag'):
+        req.add_header('If-None-Match', meta['etag'])
+
+    try:
+        response = urllib.request.urlopen(req, timeout=SUMMARY_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+
+    # Write to a temp file so an interrupted transfer never replaces the cache
+    tmp_filename = local_filename + ".part"
+    with response, open(tmp_filename, 'wb') as f:
+        shutil.copyfileobj(response, f)
+        meta = {'last_modified': response.headers.get('Last-Modified'), 'etag': response.headers.get('ETag')}
+    os.replace(tmp_filename, local_filename)
+
+    with open(meta_filename, 'w') as f:
+        json.dump(meta, f)
+    return True
+
+def read_summary(local_filename, genera=None):
+    """
+    Parses assembly_summary.txt (needed columns only).
+    Uses PyArrow's multithreaded CSV reader when installed, pandas otherwise.
+    Adds the normalized _organism_key/_genus lookup columns.
+    With `genera`, the pandas reader streams the file in chunks and keeps only rows of those genera.
+    """
+    if pacsv is None:
+        reader = pd.read_csv(local_filename, sep="\t", header=1, quoting=3, # quoting=3 disables quote processing
+                             usecols=lambda c: c.lstrip('# ') in SUMMARY_COLUMNS, dtype=SUMMARY_DTYPES, engine='c',
+                             chunksize=None if genera is None else 200_000)
+        df = add_name_keys(reader) if genera is None else pd.concat(
+            [filter_genera(add_name_keys(chunk), genera) for chunk in reader], ignore_index=True)
+        df.columns = df.columns.str.replace('# ', '').str.replace('#', '')
+        return df
+
+    # Line 1 is a comment, line 2 the '#'-prefixed header
+    with open(local_filename) as f:
+        f.readline()
+        column_names = [c.lstrip('# ') for c in f.readline().rstrip('\n').split('\t')]
+
+    table = pacsv.read_csv(
+        local_filename,
+        read_options=pacsv.ReadOptions(skip_rows=2, column_names=column_names, block_size=16 << 20, use_threads=True),
+        parse_options=pacsv.ParseOptions(delimiter='\t', quote_char=False),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=SUMMARY_COLUMNS,
+            column_types={c: pa.dictionary(pa.int32(), pa.string()) if t == 'category' else pa.string()
+                          for c, t in SUMMARY_DTYPES.items()},
+            strings_can_be_null=True,
+        ),
+    )
+    # Dictionary columns come back as Categoricals, same dtypes as the pandas path
+    return add_name_keys(table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get))
+
+def download_and_load_summary(ncbi_group, db_source, force_download=False, genera=None):
     """
     Downloads summary file for a specific DB (refseq or genbank).
-    Returns a dataframe tagged with the source.
+    Returns a dataframe tagged with the source, limited to `genera` (normalized) if given.
     """
     # URL pattern: ftp.ncbi.nlm.nih.gov/genomes/refseq/plant/... OR .../genbank/plant/...
     summary_url = f"https://ftp.ncbi.nlm.nih.gov/genomes/{db_source}/{ncbi_group}/assembly_summary.txt"
     local_filename = f"summary_{ncbi_group}_{db_source}.txt"
+    meta_filename = f"summary_{ncbi_group}_{db_source}.meta"
+    parquet_filename = f"summary_{ncbi_group}_{db_source}.parquet"
+    mtime_filename = f"summary_{ncbi_group}_{db_source}.mtime"
 
-    if force_download and os.path.exists(local_filename):
-        os.remove(local_filename)
+    if force_download:
+        for path in (local_filename, meta_filename, parquet_filename, mtime_filename):
+            if os.path.exists(path):
+                os.remove(path)
 
     if not os.path.exists(local_filename):
         print(f"[-] Downloading {db_source} summary for '{ncbi_group}'...")
         try:
-            urllib.request.urlretrieve(summary_url, local_filename)
+            fetch_summary(summary_url, local_filename, meta_filename)
         except Exception as e:
             print(f"[!] Error downloading {db_source}: {e}")
             return pd.DataFrame() # Return empty if failed (e.g. group doesn't exist in GenBank)
+    else:
+        print(f"[-] Checking {db_source} summary for '{ncbi_group}' for updates...")
+        try:
+            if fetch_summary(summary_url, local_filename, meta_filename):
+                print(f"[-] Downloaded updated {db_source} summary.")
+            else:
+                print(f"[-] Cached {db_source} summary is up to date.")
+        except Exception as e:
+            print(f"[!] Could not check {db_source} for updates ({e}). Using cached file.")
     
+    # Reuse the parsed+scored snapshot if it was built from this exact file by this snapshot format
+    snapshot_tag = f"{SNAPSHOT_VERSION}:{os.stat(local_filename).st_mtime_ns}"
+    if pa is not None and os.path.exists(parquet_filename) and os.path.exists(mtime_filename):
+        with open(mtime_filename) as f:
+            if f.read().strip() == snapshot_tag:
+                try:
+                    # Push the genus filter into the Parquet read so other genera are never materialized.
+                    # pyarrow can't type an empty value set; '' is never a genus (empty names parse as null)
+                    filters = None if genera is None else [('_genus', 'in', sorted(genera) or [''])]
+                    return pd.read_parquet(parquet_filename, filters=filters)
+                except Exception as e:
+                    print(f"[!] Error reading {parquet_filename} ({type(e).__name__}). Re-parsing.")
+
     try:
-        df = pd.read_csv(local_filename, sep="\t", header=1, dtype=str, quoting=3) # quoting=3 disables quote processing
-        df.columns = df.columns.str.replace('# ', '').str.replace('#', '')
-        df['data_source'] = db_source.upper() # Tag the data
-        return df
+        # Without pyarrow there is no snapshot to build, so filter while parsing to bound memory
+        df = read_summary(local_filename, genera if pa is None else None)
+        df['data_source'] = pd.Categorical.from_codes( # Tag the data
+            np.full(len(df), SOURCE_ORDER.index(db_source.upper()), dtype='int8'), dtype=SOURCE_DTYPE)
+        score_assemblies(df)
     except Exception as e:
         print(f"[!] Error parsing {local_filename}: {e}")
         return pd.DataFrame()
 
-def rank_assemblies(group_df):
+    if pa is not None:
+        try:
+            df.to_parquet(parquet_filename, compression='zstd', index=False)
+            with open(mtime_filename, 'w') as f:
+                f.write(snapshot_tag)
+        except Exception as e:
+            print(f"[!] Could not cache {local_filename} as Parquet: {e}")
+    return filter_genera(df, genera)
+
+def filter_genera(df, genera):
+    """
+    Keeps only the assemblies whose genus is in `genera` (None keeps everything).
+    """
+    if genera is None:
+        return df
+    return df[df['_genus'].isin(genera)].reset_index(drop=True)
+
+def add_name_keys(df):
+    """
+    Adds the normalized name and genus used for matching (stored in the Parquet snapshot).
+    """
+    df['_organism_key'] = normalize_names(df['organism_name'])
+    df['_genus'] = first_word(df['_organism_key'])
+    return df
+
+def score_assemblies(df):
+    """
+    Adds the ranking scores used by rank_assemblies().
+    Computed once per catalog (and cached with it) instead of per species.
+    """
+    # Categorical codes in ranking order double as scores (-1 for unknown/missing)
+    df['cat_score'] = (pd.Categorical(df['refseq_category'], categories=CATEGORY_ORDER).codes + 1).astype('int8')
+    df['lvl_score'] = (pd.Categorical(df['assembly_level'], categories=LEVEL_ORDER).codes + 1).astype('int8')
+    df['src_score'] = (df['data_source'].cat.codes + 1).astype('int8')
+    return df
+
+def normalize_names(names):
+    """
+    Case/whitespace-insensitive lookup key for organism names.
+    """
+    return names.str.strip().str.lower().str.replace(WHITESPACE_RE, ' ', regex=True)
+
+def first_word(keys):
+    """
+    Genus (first word) of each normalized name.
+    """
+    # split(n=1) beats str.partition here: partition materializes all three parts as columns
+    return keys.str.split(' ', n=1).str[0]
+
+def genus_keys(names):
+    """
+    Normalized genus (first word) of each organism name.
     """
-    Ranks assemblies.
+    return first_word(normalize_names(names))
+
+def rank_assemblies(df):
+    """
+    Returns the row positions of df ordered best-first (expects scores from score_assemblies()).
     Priority: 
     1. RefSeq Category (Reference > Representative)
     2. Assembly Level (Complete > Chromosome > Scaffold)
     3. Source (RefSeq > GenBank) -- ONLY if category/level are equal
     4. Date (Newest first)
     """
-    group_df = group_df.copy()
-    
-    # Ranking Weights
-    cat_map = {'reference genome': 3, 'representative genome': 2, 'na': 1}
-    level_map = {'Complete Genome': 4, 'Chromosome': 3, 'Scaffold': 2, 'Contig': 1}
-    source_map = {'REFSEQ': 2, 'GENBANK': 1} # Prefer RefSeq if quality is identical
-    
-    group_df['cat_score'] = group_df['refseq_category'].map(cat_map).fillna(0)
-    group_df['lvl_score'] = group_df['assembly_level'].map(level_map).fillna(0)
-    group_df['src_score'] = group_df['data_source'].map(source_map).fillna(0)
-    
-    # Sort
-    sorted_df = group_df.sort_values(
-        by=['cat_score', 'lvl_score', 'src_score', 'assembly_accession'], 
-        ascending=[False, False, False, False]
-    )
-    return sorted_df.iloc[0]
+    # Order rows best-first without materializing a sorted copy of the table
+    acc_rank = pd.factorize(df['assembly_accession'], sort=True)[0]
+    return np.lexsort((-acc_rank, -df['src_score'].to_numpy(), -df['lvl_score'].to_numpy(), -df['cat_score'].to_numpy()))
+
+def best_assemblies(df, key, order):
+    """
+    Best assembly for each value of `key`, indexed by that value.
+    `order` is the best-first ordering from rank_assemblies().
+    """
+    keys = df[key].to_numpy(dtype=object)[order]
+    first = ~pd.Series(keys).duplicated().to_numpy()
+    return df.iloc[order[first]].set_axis(keys[first])
 
 def main():
     args = parse_args()
     
     # 1. Config
-    user_group = args.group.lower()
+    user_group = args.group.strip().lower()
     ncbi_group = GROUP_MAPPING.get(user_group, user_group)
     
     input_file = args.input
     output_dir = args.outdir if args.outdir else f"{ncbi_group}_genomes"
     report_file = f"download_report_{ncbi_group}.log"
     download_script = f"run_downloads_{ncbi_group}.sh"
+    url_list = f"urls_{ncbi_group}.txt"
+    aria2_list = f"urls_{ncbi_group}.aria2"
 
     if not os.path.exists(input_file):
         sys.exit(f"[!] Input file '{input_file}' not found.")
 
-    # 2. Load Data (RefSeq, GenBank, or Both)
-    dfs = []
-    if args.source in ['refseq', 'both']:
-        dfs.append(download_and_load_summary(ncbi_group, 'refseq', args.clean))
-    if args.source in ['genbank', 'both']:
-        dfs.append(download_and_load_summary(ncbi_group, 'genbank', args.clean))
+    # 2. Read Species
+    with open(input_file, 'r') as f:
+        names = pd.Series(f.read().splitlines(), dtype=str).str.strip()
+    target_species = names[names != ''].reset_index(drop=True)
+
+    # Only assemblies from the targets' genera can match (exact or fallback)
+    genera = set(genus_keys(target_species))
+
+    # 3. Load Data (RefSeq, GenBank, or Both)
+    sources = ['refseq', 'genbank'] if args.source == 'both' else [args.source]
+    # Fetch both catalogs at the same time; the transfers are I/O-bound
+    # (map() drops each future once consumed, so only dfs holds the frames)
+    with ThreadPoolExecutor(max_workers=len(sources)) as ex:
+        dfs = list(ex.map(lambda src: download_and_load_summary(ncbi_group, src, args.clean, genera), sources))
+    dfs = [d for d in dfs if not d.columns.empty] # Drop sources that failed to load
     
-    if not dfs or all(d.empty for d in dfs):
+    if not dfs:
         sys.exit("[!] No summary data found. Check internet or group name.")
 
     # Merge
     full_df = pd.concat(dfs, ignore_index=True)
-    print(f"[-] Loaded {len(full_df)} assemblies from {args.source.upper()}.")
-
-    # 3. Process Species
-    with open(input_file, 'r') as f:
-        target_species = [line.strip() for line in f if line.strip()]
+    del dfs
+    gc.collect() # Release the per-source frames before building the lookup tables
+    print(f"[-] Loaded {len(full_df)} assemblies of the target genera from {args.source.upper()}.")
 
-    to_download = []
-    
+    # 4. Process Species
     print(f"[-] Matching {len(target_species)} species...")
 
-    for species in target_species:
-        # A. Exact Match
-        matches = full_df[full_df['organism_name'] == species]
-        
-        if not matches.empty:
-            best = rank_assemblies(matches)
-            to_download.append({
-                'name': species,
-                'source': best['data_source'],
-                'accession': best['assembly_accession'],
-                'url': best['ftp_path'],
-                'status': 'EXACT_MATCH',
-                'level': best['assembly_level']
-            })
-        else:
-            # B. Genus Fallback
-            parts = species.split(" ")
-            if len(parts) >= 1 and len(parts[0]) > 2:
-                genus = parts[0]
-                genus_matches = full_df[full_df['organism_name'].str.contains(f"^{genus} ", regex=True, na=False)]
-                
-                if not genus_matches.empty:
-                    best = rank_assemblies(genus_matches)
-                    to_download.append({
-                        'name': species,
-                        'source': best['data_source'],
-                        'accession': best['assembly_accession'],
-                        'url': best['ftp_path'],
-                        'status': f"FALLBACK ({best['organism_name']})",
-                        'level': best['assembly_level']
-                    })
-                else:
-                    to_download.append({'name': species, 'source': '-', 'accession': '-', 'url': 'N/A', 'status': 'NOT_FOUND', 'level': '-'})
-            else:
-                to_download.append({'name': species, 'source': '-', 'accession': '-', 'url': 'N/A', 'status': 'NOT_FOUND', 'level': '-'})
+    targets = pd.DataFrame({'name': target_species})
+    targets['_organism_key'] = normalize_names(targets['name'])
+    targets['_genus'] = first_word(targets['_organism_key'])
+
+    # Rank once, keep the best row per species / per genus, then resolve every target by index lookup
+    cols = ['organism_name', 'data_source', 'assembly_accession', 'ftp_path', 'assembly_level']
+    order = rank_assemblies(full_df)
+    best_species = best_assemblies(full_df, '_organism_key', order)[cols]
+    best_genus = best_assemblies(full_df, '_genus', order)[cols]
+
+    # A. Exact Match
+    exact = best_species.reindex(targets['_organism_key']).reset_index(drop=True)
+    # B. Genus Fallback
+    fallback = best_genus.reindex(targets['_genus']).reset_index(drop=True)
 
-    # 4. Report & Script
-    found_count = 0
+    is_exact = exact['assembly_accession'].notna()
+    is_fallback = ~is_exact & fallback['assembly_accession'].notna() & (targets['_genus'].str.len() > 2)
+    best = exact[cols].astype(object).where(is_exact, fallback[cols].astype(object))
+
+    report = pd.DataFrame({
+        'name': targets['name'],
+        'status': np.select([is_exact, is_fallback], ['EXACT_MATCH', "FALLBACK (" + best['organism_name'] + ")"], 'NOT_FOUND'),
+        'source': best['data_source'],
+        'accession': best['assembly_accession'],
+        'level': best['assembly_level'],
+        'url': best['ftp_path'],
+    })
+    not_found = ~(is_exact | is_fallback)
+    report.loc[not_found, ['source', 'accession', 'level']] = '-'
+    report.loc[not_found, 'url'] = 'N/A'
+
+    # 5. Report & Script
+    # Written raw (no CSV quoting): NCBI names contain stray quotes and the log must show them as-is
+    fields = [report[c].astype(object).fillna('nan').astype(str) for c in report.columns]
+    report_lines = fields[0]
+    for field in fields[1:]:
+        report_lines = report_lines + "\t" + field
     with open(report_file, 'w') as f:
         f.write("Target_Species\tStatus\tSource\tAccession\tLevel\tURL\n")
-        for item in to_download:
-            if item['url'] != "N/A": found_count += 1
-            f.write(f"{item['name']}\t{item['status']}\t{item['source']}\t{item['accession']}\t{item['level']}\t{item['url']}\n")
+        f.write("".join(report_lines + "\n"))
+
+    found = report[report['url'] != "N/A"]
+    found_count = len(found)
+    downloads = found.drop_duplicates('accession')
+    # Handle GenBank vs RefSeq FTP path differences (usually they are consistent)
+    full_urls = downloads['url'] + "/" + downloads['url'].map(os.path.basename) + "_genomic.fna.gz"
+    url_lines = f"{output_dir}/" + downloads['accession'] + ".fna.gz\t" + full_urls + "\n"
+    aria2_lines = full_urls + f"\n  dir={output_dir}\n  out=" + downloads['accession'] + ".fna.gz\n"
+
+    with open(url_list, 'w') as f:
+        f.write("".join(url_lines))
+    with open(aria2_list, 'w') as f:
+        f.write("".join(aria2_lines))
 
+    # Downloads are latency-bound: prefer aria2c (several connections per file), else parallel wget
+    jobs = max(args.jobs, 1)
     with open(download_script, 'w') as f:
         f.write("#!/bin/bash\n")
         f.write(f"mkdir -p {output_dir}\n")
-        for item in to_download:
-            if item['url'] != "N/A":
-                # Handle GenBank vs RefSeq FTP path differences (usually they are consistent)
-                base_name = os.path.basename(item['url'])
-                full_url = f"{item['url']}/{base_name}_genomic.fna.gz"
-                f.write(f"echo 'Downloading {item['name']} from {item['source']}...'\n")
-                f.write(f"wget -q --show-progress -O {output_dir}/{item['accession']}.fna.gz {full_url}\n")
+        f.write(f"[ -s {url_list} ] || exit 0 # Nothing resolved, nothing to download\n")
+        f.write("if command -v aria2c >/dev/null 2>&1; then\n")
+        f.write(f"    aria2c -i {aria2_list} -j {jobs} -x 4 -s 4 --continue=true --auto-file-renaming=false "
+                "--conditional-get=true --remote-time=true\n")
+        f.write("else\n")
+        # Versioned assemblies never change, so skip files already on disk; .part keeps interrupted ones from counting
+        f.write(f"    xargs -r -n 2 -P {jobs} sh -c '[ -s \"$0\" ] && exit 0; echo \"Downloading $0...\"; "
+                f"wget -q -O \"$0.part\" \"$1\" && mv \"$0.part\" \"$0\"' < {url_list}\n")
+        f.write("fi\n")
 
     print(f"[-] Done. Found {found_count}/{len(target_species)}.")
     print(f"[-] View report: {report_file}")